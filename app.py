@@ -1,21 +1,51 @@
 from __future__ import annotations
 
+import hashlib
 import os
+import socket
+import sys
+import threading
 import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FetchTimeout
+from email.utils import parsedate_to_datetime
 from typing import Dict, Tuple, Any, Optional
 
-import requests
-from flask import Flask, jsonify, render_template, request
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from cachetools import TTLCache
+import httpx
+import orjson
+import redis
+from flask import Flask, render_template, request
+from flask.json.provider import DefaultJSONProvider
+
+from ttl_cache import ExpiringCache
 
 try:
     from config import Config
 except ImportError:
     raise RuntimeError("Missing config.py with Config class.")
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    orjson for Flask's own JSON helpers (jsonify, request.get_json, the
+    tojson template filter). API routes bypass it and encode with
+    orjson.dumps directly via json_response.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        # keep Flask's default key-sorted output (app.json.sort_keys)
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config.from_object(Config)
 
 if not app.config.get("OPENWEATHER_API_KEY"):
@@ -23,50 +53,173 @@ if not app.config.get("OPENWEATHER_API_KEY"):
         "Missing OPENWEATHER_API_KEY. Put it in .env or environment."
     )
 
-
-# --- Robust requests session with retries ---
-def build_session() -> requests.Session:
-    s = requests.Session()
-    retries = Retry(
-        total=4,
-        backoff_factor=0.4,
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=frozenset(["GET"]),
-        raise_on_status=False,
+# Read once: the config does not change after startup
+APPID = app.config["OPENWEATHER_API_KEY"]
+GEO_LIMIT = app.config["GEO_LIMIT"]
+ORIGIN = app.config["ALLOWED_ORIGIN"]
+DEFAULT_UNITS = app.config["DEFAULT_UNITS"].lower()
+CACHE_TTL = app.config["CACHE_TTL"]
+
+UNITS = frozenset(("metric", "imperial", "standard"))
+
+# lat/lon rounding for cache keys (2 decimals = ~1 km)
+COORD_DECIMALS = 2
+
+# Timestamps here only need second resolution, so on Linux read the
+# coarse clock (no hardware counter read); elsewhere plain time.time().
+# CLOCK_REALTIME_COARSE is 5 in <linux/time.h>; Python does not export it.
+if sys.platform.startswith("linux"):
+
+    def wall_clock() -> float:
+        return time.clock_gettime(5)
+
+else:
+    wall_clock = time.time
+
+
+# --- Shared HTTP/2 client (one multiplexed connection to OpenWeather) ---
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+MAX_RETRIES = 4
+# Total seconds owm_get may spend sleeping between retries; covers the
+# default backoff (0.4 + 0.8 + 1.6 + 3.2) but not a long Retry-After
+RETRY_BUDGET = 6.0
+
+
+def build_client() -> httpx.Client:
+    timeout = app.config["HTTP_TIMEOUT"]
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        timeout = httpx.Timeout(read, connect=connect)
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=MAX_RETRIES,  # connect failures only; status retries in owm_get
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            # keep the TLS connection warm between misses (httpx default: 5s)
+            keepalive_expiry=75,
+        ),
+        socket_options=[
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ],
     )
-    adapter = HTTPAdapter(max_retries=retries)
-    s.mount("http://", adapter)
-    s.mount("https://", adapter)
-    return s
+    return httpx.Client(transport=transport, timeout=timeout)
+
 
+client = build_client()
 
-session = build_session()
+# How long a request waits on a coalesced fetch before answering 504:
+# geocode, then current + forecast in parallel, each allowed one full
+# connect + read plus the retry sleeps. The fetch itself keeps running
+# and still fills the cache for the next request.
+_timeout = app.config["HTTP_TIMEOUT"]
+ATTEMPT_TIMEOUT = sum(_timeout) if isinstance(_timeout, tuple) else 2 * _timeout
+FETCH_TIMEOUT = 2 * (ATTEMPT_TIMEOUT + RETRY_BUDGET)
 
-# --- Simple in-memory cache (city/coords + units) ---
+
+def retry_delay(r: httpx.Response, attempt: int) -> float:
+    # Honour Retry-After on 429/503 (seconds or HTTP date), as urllib3 did
+    retry_after = r.headers.get("Retry-After")
+    if retry_after and r.status_code in (429, 503):
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(retry_after)
+            return max(0.0, when.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return 0.4 * 2**attempt
+
+
+def owm_get(url: str, params: Dict[str, Any]) -> httpx.Response:
+    # Retry throttling / transient upstream errors with exponential backoff;
+    # give up (returning the error) once the sleeps would exceed RETRY_BUDGET
+    attempt = 0
+    slept = 0.0
+    while True:
+        r = client.get(url, params=params)
+        if r.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return r
+        delay = retry_delay(r, attempt)
+        if slept + delay > RETRY_BUDGET:
+            return r
+        time.sleep(delay)
+        slept += delay
+        attempt += 1
+
+
+# --- Worker pool for concurrent upstream calls ---
+# current + forecast are independent, so fetch them side by side
+upstream_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="owm")
+
+# Cache-filling fetches, for misses and stale refreshes alike (separate
+# pool: fetch jobs wait on upstream_pool, sharing one could deadlock)
+fetch_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="fetch")
+
+# --- Cache (city/coords + units) ---
 # cache key: (kind, query_string, units) where kind ∈ {"city","coords"}
-cache: TTLCache[Tuple[str, str, str], Dict[str, Any]] = TTLCache(
-    maxsize=512, ttl=app.config["CACHE_TTL"]
+# values are (fresh_until, encoded JSON payload, etag): hits skip re-encoding,
+# and entries past fresh_until are still served while refreshed in background
+ENTRY_TTL = CACHE_TTL + app.config["CACHE_STALE_TTL"]
+
+# Admission limit: one oversized payload is not worth evicting many small ones
+CACHE_MAX_ENTRY_BYTES = 128_000
+
+# With REDIS_URL set, Redis is the shared cache across workers and the
+# in-process cache shrinks to a short-lived L1 for hot keys
+redis_client: Optional[redis.Redis] = (
+    redis.Redis.from_url(
+        app.config["REDIS_URL"],
+        max_connections=32,
+        # a hung Redis must degrade to a miss, not block the request
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5,
+    )
+    if app.config["REDIS_URL"]
+    else None
 )
+if redis_client is not None:
+    cache = ExpiringCache(maxsize=64, ttl=10)
+else:
+    cache = ExpiringCache(maxsize=512, ttl=ENTRY_TTL)
+
+# One upstream fetch per cache key at a time
+inflight: Dict[Tuple[str, str, str], Future] = {}
+inflight_lock = threading.Lock()
+
+# Negative cache for queries that geocode to nothing (shorter TTL)
+geo_misses = ExpiringCache(maxsize=1024, ttl=app.config["GEO_MISS_TTL"])
 
 
 # --- Helpers ---
-def corsify(resp):
-    # Basic CORS for simple demos (same-origin preferred)
-    resp.headers["Access-Control-Allow-Origin"] = app.config["ALLOWED_ORIGIN"]
-    resp.headers["Vary"] = "Origin"
-    return resp
+# Basic CORS for simple demos (same-origin preferred); built once and
+# passed to every response instead of setting headers one by one
+CORS_HEADERS = {"Access-Control-Allow-Origin": ORIGIN, "Vary": "Origin"}
+JSON_HEADERS = {**CORS_HEADERS, "Content-Type": "application/json"}
+
+
+def json_response(body: bytes, status: int = 200):
+    return app.response_class(body, status=status, headers=JSON_HEADERS)
+
+
+def mark_cached(body: bytes) -> bytes:
+    # Splice "cached": true into the encoded object instead of re-encoding it
+    return body[:-1] + b',"cached":true}'
 
 
 def owm_geo(q: str):
     url = "https://api.openweathermap.org/geo/1.0/direct"
     params = {
         "q": q,
-        "limit": app.config["GEO_LIMIT"],
-        "appid": app.config["OPENWEATHER_API_KEY"],
+        "limit": GEO_LIMIT,
+        "appid": APPID,
     }
-    r = session.get(url, params=params, timeout=app.config["HTTP_TIMEOUT"])
+    r = owm_get(url, params)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     if not data:
         return None
     # return first match
@@ -80,108 +233,240 @@ def owm_geo(q: str):
     }
 
 
-def owm_current(lat: float, lon: float, units: str):
+def owm_current(params: Dict[str, Any]):
     url = "https://api.openweathermap.org/data/2.5/weather"
-    params = {
-        "lat": lat,
-        "lon": lon,
-        "appid": app.config["OPENWEATHER_API_KEY"],
-        "units": units,
-    }
-    r = session.get(url, params=params, timeout=app.config["HTTP_TIMEOUT"])
+    r = owm_get(url, params)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def owm_forecast(lat: float, lon: float, units: str):
-    # 5 day / 3-hour forecast
+def owm_forecast(params: Dict[str, Any]) -> bytes:
+    # 5 day / 3-hour forecast, returned undecoded (see store_payload)
     url = "https://api.openweathermap.org/data/2.5/forecast"
-    params = {
-        "lat": lat,
-        "lon": lon,
-        "appid": app.config["OPENWEATHER_API_KEY"],
-        "units": units,
-    }
-    r = session.get(url, params=params, timeout=app.config["HTTP_TIMEOUT"])
+    r = owm_get(url, params)
     r.raise_for_status()
-    return r.json()
+    # The body is spliced into the payload unparsed, so at least make sure
+    # it is a JSON object before it can end up cached
+    body = r.content.strip()
+    if not (
+        r.headers.get("Content-Type", "").startswith("application/json")
+        and body.startswith(b"{")
+        and body.endswith(b"}")
+    ):
+        raise ValueError("OpenWeather forecast response is not a JSON object")
+    return body
+
+
+def fetch_weather(place, units: str):
+    # Run current in the pool while this thread fetches the forecast,
+    # so a miss costs max(t_current, t_forecast) instead of the sum.
+    # Both endpoints take the same query, so build it once per miss
+    params = {"lat": place["lat"], "lon": place["lon"], "appid": APPID, "units": units}
+    current_fut = upstream_pool.submit(owm_current, params)
+    forecast = owm_forecast(params)
+    return current_fut.result(), forecast
 
 
 def cache_key_for_coords(lat: float, lon: float, units: str) -> Tuple[str, str, str]:
     return ("coords", f"{lat},{lon}", units)
 
 
+def normalize_query(q: str) -> str:
+    # "  London , UK" and "london,uk" share one cache entry and geocode
+    # lookup (OWM geocoding is case-insensitive)
+    q = " ".join(unicodedata.normalize("NFKC", q).lower().split())
+    return q.replace(" ,", ",").replace(", ", ",")
+
+
 def cache_key_for_city(q: str, units: str) -> Tuple[str, str, str]:
     return ("city", q, units)
 
 
+def redis_key(key: Tuple[str, str, str]) -> bytes:
+    return b"wx:" + "|".join(key).encode()
+
+
+def redis_get(key):
+    try:
+        raw = redis_client.get(redis_key(key))
+    except redis.RedisError as e:
+        app.logger.warning("Redis get failed: %s", e)
+        return None
+    if raw is None:
+        return None
+    try:
+        fresh_until, etag, body = raw.split(b" ", 2)
+        return (int(fresh_until), body, etag.decode())
+    except ValueError:
+        app.logger.warning("Ignoring malformed Redis entry for %r", key)
+        return None
+
+
+def redis_set(key, entry: Tuple[float, bytes, str]):
+    fresh_until, body, etag = entry
+    try:
+        redis_client.set(
+            redis_key(key),
+            b"%d %s %s" % (fresh_until, etag.encode(), body),
+            ex=ENTRY_TTL,
+        )
+    except redis.RedisError as e:
+        app.logger.warning("Redis set failed: %s", e)
+
+
 def get_cached_or_none(key):
-    return cache.get(key) if key in cache else None
+    entry = cache.get(key)
+    if entry is None and redis_client is not None:
+        entry = redis_get(key)
+        if entry is not None:
+            cache[key] = entry
+    return entry
+
+
+def store_payload(key, payload, forecast_raw: bytes) -> Tuple[float, bytes, str]:
+    # Splice the upstream forecast body in verbatim instead of decoding and
+    # re-encoding ~40 entries; it is a superset of {"city", "list"}
+    body = orjson.dumps(payload)[:-1] + b',"forecast":' + forecast_raw + b"}"
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    entry = (payload["fetched_at"] + CACHE_TTL, body, etag)
+    if len(body) <= CACHE_MAX_ENTRY_BYTES:
+        cache[key] = entry
+        if redis_client is not None:
+            redis_set(key, entry)
+    return entry
+
+
+class GeocodeNotFound(Exception):
+    def __init__(self, q: str):
+        super().__init__(q)
+        self.q = q
+
+
+def geocode_miss_response(q: str):
+    return json_response(orjson.dumps({"error": f"No geocode results for '{q}'"}), 404)
+
+
+def geocode(q: str):
+    geo = owm_geo(q)
+    if not geo:
+        # only a real upstream miss starts the TTL (no sliding expiry)
+        geo_misses[("geo_miss", q)] = True
+        raise GeocodeNotFound(q)
+    return geo
+
+
+def fetch_and_cache(key, place, units: str) -> Tuple[float, bytes, str]:
+    try:
+        if place is None:
+            # city key: ("city", normalized q, units); geocoded only on a
+            # miss or refresh, never on the cache-hit path
+            place = geocode(key[1])
+        current, forecast = fetch_weather(place, units)
+        return store_payload(key, combine_payload(place, current, units), forecast)
+    finally:
+        with inflight_lock:
+            inflight.pop(key, None)
+
+
+def submit_fetch(key, place, units: str, background: bool = False) -> Future:
+    # Coalesce: reuse the in-flight fetch for this key if there is one
+    with inflight_lock:
+        fut = inflight.get(key)
+        if fut is None:
+            fut = fetch_pool.submit(fetch_and_cache, key, place, units)
+            inflight[key] = fut
+            if background:
+                # nobody waits on a refresh; log its failure once, here
+                fut.add_done_callback(log_refresh_failure)
+    return fut
+
+
+def log_refresh_failure(fut: Future):
+    exc = fut.exception()
+    if exc is None:
+        return
+    # never log str(exc): httpx errors embed the request URL, appid included
+    if isinstance(exc, httpx.HTTPStatusError):
+        app.logger.warning(
+            "Background refresh failed: HTTP %s", exc.response.status_code
+        )
+    else:
+        app.logger.warning("Background refresh failed: %s", type(exc).__name__)
+
+
+def weather_response(entry: Tuple[float, bytes, str], cached: bool):
+    fresh_until, body, etag = entry
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304, headers=CORS_HEADERS)
+    else:
+        resp = json_response(mark_cached(body) if cached else body)
+    # weak: hits and misses differ only by the "cached" flag
+    resp.set_etag(etag, weak=True)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = max(0, int(fresh_until - wall_clock()))
+    return resp
 
 
 def resolve_place(
     lat: Optional[str], lon: Optional[str], q: Optional[str], units: str
 ):
     """
-    Return ((key, place_dict), None) on success
-    Or (None, (error_response, status)) on error
+    Return ((key, place_dict), None) on success; place_dict is None for
+    city queries, which are geocoded by fetch_and_cache on a cache miss
+    Or (None, error_response) on error
     """
     if lat and lon:
         try:
-            lat_f = float(lat)
-            lon_f = float(lon)
+            # ~1 km grid so nearby GPS fixes share one cache entry
+            # (+ 0.0 folds -0.0 into 0.0)
+            lat_f = round(float(lat), COORD_DECIMALS) + 0.0
+            lon_f = round(float(lon), COORD_DECIMALS) + 0.0
         except ValueError:
-            return None, (corsify(jsonify({"error": "lat/lon must be numbers"})), 400)
+            return None, json_response(orjson.dumps({"error": "lat/lon must be numbers"}), 400)
         key = cache_key_for_coords(lat_f, lon_f, units)
         return (key, {"name": None, "lat": lat_f, "lon": lon_f}), None
 
-    q = (q or "").strip()
+    q = normalize_query(q or "")
     if not q:
-        return None, (corsify(jsonify({"error": "q (city) must be non-empty"})), 400)
+        return None, json_response(orjson.dumps({"error": "q (city) must be non-empty"}), 400)
     if len(q) > 100:
-        return None, (corsify(jsonify({"error": "q too long"})), 400)
+        return None, json_response(orjson.dumps({"error": "q too long"}), 400)
 
-    key = cache_key_for_city(q, units)
-    geo = owm_geo(q)
-    if not geo:
-        return None, (corsify(jsonify({"error": f"No geocode results for '{q}'"})), 404)
-    return (key, geo), None
+    if geo_misses.get(("geo_miss", q)):
+        return None, geocode_miss_response(q)
+    return (cache_key_for_city(q, units), None), None
 
 
-def combine_payload(place, current, forecast, units):
-    main = current.get("main", {}) if isinstance(current, dict) else {}
-    wind = current.get("wind", {}) if isinstance(current, dict) else {}
-    clouds = current.get("clouds", {}) if isinstance(current, dict) else {}
-    weather_arr = current.get("weather", []) if isinstance(current, dict) else []
+# Shared read-only default for optional OWM sections (never mutated)
+_EMPTY: Dict[str, Any] = {}
+
+
+def combine_payload(place, current, units):
+    # current is a decoded 200 response, i.e. always a dict; only
+    # sections OWM may omit go through .get(). "forecast" is added
+    # by store_payload.
+    main = current["main"]
+    wind = current.get("wind", _EMPTY)
+    sys_ = current.get("sys", _EMPTY)
 
     return {
         "place": place,
         "units": units,
-        "fetched_at": int(time.time()),
+        "fetched_at": int(wall_clock()),
         "current": {
-            "dt": current.get("dt") if isinstance(current, dict) else None,
+            "dt": current.get("dt"),
             "temp": main.get("temp"),
             "feels_like": main.get("feels_like"),
             "humidity": main.get("humidity"),
             "pressure": main.get("pressure"),
             "wind_speed": wind.get("speed"),
             "wind_deg": wind.get("deg"),
-            "clouds": clouds.get("all"),
+            "clouds": current.get("clouds", _EMPTY).get("all"),
             # keep full array to match frontend expectations (weather[0])
-            "weather": weather_arr,
-            "visibility": current.get("visibility")
-            if isinstance(current, dict)
-            else None,
-            "sunrise": current.get("sys", {}).get("sunrise")
-            if isinstance(current, dict)
-            else None,
-            "sunset": current.get("sys", {}).get("sunset")
-            if isinstance(current, dict)
-            else None,
-        },
-        "forecast": {
-            "city": forecast.get("city", {}) if isinstance(forecast, dict) else {},
-            "list": forecast.get("list", []) if isinstance(forecast, dict) else [],
+            "weather": current.get("weather", ()),
+            "visibility": current.get("visibility"),
+            "sunrise": sys_.get("sunrise"),
+            "sunset": sys_.get("sunset"),
         },
     }
 
@@ -200,15 +485,17 @@ def api_weather():
         - lat, lon: coordinates (if provided, takes precedence over q)
         - units: "metric" | "imperial" | "standard"
     """
-    units = (request.args.get("units") or app.config["DEFAULT_UNITS"]).lower()
-    if units not in {"metric", "imperial", "standard"}:
-        units = app.config["DEFAULT_UNITS"].lower()
+    units = (request.args.get("units") or DEFAULT_UNITS).lower()
+    if units not in UNITS:
+        units = DEFAULT_UNITS
     lat = request.args.get("lat")
     lon = request.args.get("lon")
     q = request.args.get("q")
 
     if not ((lat and lon) or q):
-        return corsify(jsonify({"error": "Provide either (lat & lon) or q=<city>"})), 400
+        return json_response(
+            orjson.dumps({"error": "Provide either (lat & lon) or q=<city>"}), 400
+        )
 
     try:
         resolved, err = resolve_place(lat, lon, q, units)
@@ -218,37 +505,41 @@ def api_weather():
 
         cached = get_cached_or_none(key)
         if cached is not None:
-            return corsify(jsonify({**cached, "cached": True}))
-
-        current = owm_current(place["lat"], place["lon"], units)
-        forecast = owm_forecast(place["lat"], place["lon"], units)
-        payload = combine_payload(place, current, forecast, units)
-        cache[key] = payload
-        return corsify(jsonify(payload))
-    except requests.HTTPError as e:
-        status = e.response.status_code if e.response is not None else 502
+            if wall_clock() >= cached[0]:
+                # stale-while-revalidate: answer now, refresh behind the scenes
+                submit_fetch(key, place, units, background=True)
+            return weather_response(cached, cached=True)
+
+        # single-flight: concurrent misses for one key share a single fetch
+        entry = submit_fetch(key, place, units).result(timeout=FETCH_TIMEOUT)
+        return weather_response(entry, cached=False)
+    except FetchTimeout:
+        return json_response(
+            orjson.dumps({"error": "OpenWeather request timed out"}), 504
+        )
+    except GeocodeNotFound as e:
+        return geocode_miss_response(e.q)
+    except httpx.HTTPStatusError as e:
+        status = e.response.status_code
         owm_message = None
         try:
-            if (
-                e.response is not None
-                and e.response.headers.get("Content-Type", "").startswith("application/json")
-            ):
-                body = e.response.json()
+            if e.response.headers.get("Content-Type", "").startswith("application/json"):
+                body = orjson.loads(e.response.content)
                 owm_message = body.get("message") or body.get("error")
         except Exception:
             pass
         payload = {"error": "OpenWeather request failed", "status": status}
         if owm_message:
             payload["owm_message"] = owm_message
-        return corsify(jsonify(payload)), status
+        return json_response(orjson.dumps(payload), status)
     except Exception as e:
-        return corsify(jsonify({"error": "Server error", "detail": str(e)})), 500
+        return json_response(orjson.dumps({"error": "Server error", "detail": str(e)}), 500)
 
 
 # Optional: health endpoint
 @app.get("/healthz")
 def health():
-    return corsify(jsonify({"status": "ok"}))
+    return json_response(orjson.dumps({"status": "ok"}))
 
 
 if __name__ == "__main__":
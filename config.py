@@ -20,6 +20,12 @@ class Config:
     # Cache TTL (seconds)
     CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))  # default: 5 min
 
+    # How long past CACHE_TTL a stale entry is still served while it refreshes
+    CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "600"))  # default: 10 min
+
+    # TTL for cached "no geocode results" answers (seconds)
+    GEO_MISS_TTL = int(os.getenv("GEO_MISS_TTL", "60"))
+
     # HTTP timeouts (connect, read) → safe parsing
     _timeout_raw = os.getenv("HTTP_TIMEOUT", "3.5,7")
     try:
@@ -28,5 +34,8 @@ class Config:
     except Exception:
         HTTP_TIMEOUT = (3.5, 7)
 
+    # Optional shared cache across workers, e.g. redis://localhost:6379/0
+    REDIS_URL = os.getenv("REDIS_URL")
+
     # Allowed origin for CORS
     ALLOWED_ORIGIN = os.getenv("ALLOWED_ORIGIN", "http://localhost:5000")
@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import threading
+import time
+
+os.environ.setdefault("OPENWEATHER_API_KEY", "test-key")
+
+import httpx
+import pytest
+
+import app as weather_app
+from ttl_cache import ExpiringCache
+
+GEO = [{"name": "London", "lat": 51.5074, "lon": -0.1278, "country": "GB"}]
+CURRENT = {
+    "dt": 1700000000,
+    "main": {"temp": 11.2, "feels_like": 10.1, "humidity": 81, "pressure": 1012},
+    "wind": {"speed": 4.1, "deg": 240},
+    "clouds": {"all": 75},
+    "weather": [{"id": 803, "main": "Clouds", "icon": "04d"}],
+    "visibility": 10000,
+    "sys": {"sunrise": 1699990000, "sunset": 1700020000},
+}
+FORECAST = {
+    "cod": "200",
+    "cnt": 2,
+    "list": [
+        {"dt": 1700010800, "main": {"temp": 10.5}, "weather": [{"icon": "04d"}]},
+        {"dt": 1700021600, "main": {"temp": 9.8}, "weather": [{"icon": "10n"}]},
+    ],
+    "city": {"name": "London", "timezone": 0},
+}
+DEFAULTS = {"direct": GEO, "weather": CURRENT, "forecast": FORECAST}
+
+
+class Upstream:
+    """Mock OpenWeather: counts calls per endpoint, responses overridable."""
+
+    def __init__(self):
+        self.calls = []
+        self.responses = {}
+        self.delay = 0.0
+
+    def __call__(self, request):
+        endpoint = request.url.path.rsplit("/", 1)[-1]  # direct|weather|forecast
+        self.calls.append(endpoint)
+        if self.delay:
+            time.sleep(self.delay)
+        if endpoint in self.responses:
+            return self.responses[endpoint](request)
+        return httpx.Response(200, json=DEFAULTS[endpoint])
+
+    def count(self, endpoint):
+        return self.calls.count(endpoint)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    up = Upstream()
+    monkeypatch.setattr(
+        weather_app, "client", httpx.Client(transport=httpx.MockTransport(up))
+    )
+    monkeypatch.setattr(
+        weather_app, "cache", ExpiringCache(maxsize=512, ttl=weather_app.ENTRY_TTL)
+    )
+    monkeypatch.setattr(weather_app, "geo_misses", ExpiringCache(maxsize=1024, ttl=60))
+    monkeypatch.setattr(weather_app, "inflight", {})
+    monkeypatch.setattr(weather_app, "redis_client", None)
+    return up
+
+
+@pytest.fixture
+def client(upstream):
+    return weather_app.app.test_client()
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting for condition"
+        time.sleep(0.01)
+
+
+def test_city_hit_skips_geocoding(client, upstream):
+    assert client.get("/api/weather?q=London").status_code == 200
+    upstream.responses["direct"] = lambda request: httpx.Response(503)
+
+    resp = client.get("/api/weather?q=London")
+
+    assert resp.status_code == 200
+    assert resp.get_json()["cached"] is True
+    assert upstream.count("direct") == 1
+
+
+def test_stale_hit_is_served_and_refreshed(client, upstream, monkeypatch):
+    monkeypatch.setattr(weather_app, "CACHE_TTL", -1)  # every entry is stale
+    client.get("/api/weather?lat=51.5&lon=-0.12")
+
+    resp = client.get("/api/weather?lat=51.5&lon=-0.12")
+
+    assert resp.status_code == 200
+    assert resp.get_json()["cached"] is True
+    wait_for(lambda: upstream.count("weather") == 2)
+
+
+def test_failed_refresh_keeps_stale_entry_and_logs_once(
+    client, upstream, monkeypatch, caplog
+):
+    monkeypatch.setattr(weather_app, "CACHE_TTL", -1)
+    client.get("/api/weather?lat=51.5&lon=-0.12")
+    upstream.delay = 0.3  # keep the refresh in flight across all hits
+    upstream.responses["weather"] = lambda request: httpx.Response(401)
+
+    with caplog.at_level(logging.WARNING):
+        for _ in range(3):
+            resp = client.get("/api/weather?lat=51.5&lon=-0.12")
+            assert resp.status_code == 200
+            assert resp.get_json()["cached"] is True
+        # the warning comes from the refresh future's done-callback
+        wait_for(lambda: "refresh failed" in caplog.text)
+
+    failures = [r for r in caplog.records if "refresh failed" in r.getMessage()]
+    assert len(failures) == 1
+    assert weather_app.APPID not in caplog.text
+
+
+def test_concurrent_misses_share_one_fetch(upstream):
+    upstream.delay = 0.2
+    statuses = []
+
+    def get():
+        resp = weather_app.app.test_client().get("/api/weather?lat=48.85&lon=2.35")
+        statuses.append(resp.status_code)
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert statuses == [200] * 8
+    assert upstream.count("weather") == 1
+    assert upstream.count("forecast") == 1
+
+
+def test_slow_fetch_answers_504(client, upstream, monkeypatch):
+    monkeypatch.setattr(weather_app, "FETCH_TIMEOUT", 0.05)
+    upstream.delay = 0.3
+
+    resp = client.get("/api/weather?lat=48.85&lon=2.35")
+
+    assert resp.status_code == 504
+    wait_for(lambda: not weather_app.inflight)
+
+
+def test_matching_etag_gets_304(client):
+    first = client.get("/api/weather?q=London")
+    etag = first.headers["ETag"]
+
+    resp = client.get("/api/weather?q=London", headers={"If-None-Match": etag})
+
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert resp.headers["ETag"] == etag
+    assert resp.headers["Access-Control-Allow-Origin"] == weather_app.ORIGIN
+
+
+def test_stale_etag_gets_full_body(client):
+    client.get("/api/weather?q=London")
+
+    resp = client.get("/api/weather?q=London", headers={"If-None-Match": '"other"'})
+
+    assert resp.status_code == 200
+    assert resp.get_json()["cached"] is True
+
+
+def test_spliced_forecast_is_valid_json(client):
+    miss = client.get("/api/weather?q=London")
+    hit = client.get("/api/weather?q=London")
+
+    miss_body = json.loads(miss.data)
+    hit_body = json.loads(hit.data)
+    assert "cached" not in miss_body
+    assert hit_body.pop("cached") is True
+    assert hit_body == miss_body
+    assert miss_body["forecast"]["list"] == FORECAST["list"]
+    assert miss_body["forecast"]["city"] == FORECAST["city"]
+    assert miss_body["current"]["temp"] == CURRENT["main"]["temp"]
+
+
+def test_non_json_forecast_is_not_cached(client, upstream):
+    upstream.responses["forecast"] = lambda request: httpx.Response(200, content=b"")
+
+    resp = client.get("/api/weather?q=London")
+
+    assert resp.status_code == 500
+    assert len(weather_app.cache) == 0
+
+
+@pytest.fixture
+def fake_redis(upstream, monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeRedis()
+    monkeypatch.setattr(weather_app, "redis_client", server)
+    monkeypatch.setattr(weather_app, "cache", ExpiringCache(maxsize=64, ttl=10))
+    return server
+
+
+def test_redis_entry_is_shared_across_l1_caches(client, upstream, fake_redis, monkeypatch):
+    first = client.get("/api/weather?q=London")
+    # another worker: empty L1, upstream down
+    monkeypatch.setattr(weather_app, "cache", ExpiringCache(maxsize=64, ttl=10))
+    upstream.responses["weather"] = lambda request: httpx.Response(401)
+
+    resp = client.get("/api/weather?q=London")
+
+    assert resp.status_code == 200
+    assert resp.get_json()["cached"] is True
+    assert resp.headers["ETag"] == first.headers["ETag"]
+    assert 0 < fake_redis.ttl(b"wx:city|london|metric") <= weather_app.ENTRY_TTL
+
+
+def test_malformed_redis_entry_is_a_miss(client, upstream, fake_redis):
+    fake_redis.set(b"wx:city|london|metric", b"garbage")
+
+    resp = client.get("/api/weather?q=London")
+
+    assert resp.status_code == 200
+    assert "cached" not in resp.get_json()
+    assert upstream.count("weather") == 1
+
+
+@pytest.mark.parametrize(
+    "raw",
+    ["london,uk", "London,UK", "  LONDON , uk ", "london,  uk", "ｌｏｎｄｏｎ,ｕｋ"],
+)
+def test_normalize_query(raw):
+    assert weather_app.normalize_query(raw) == "london,uk"
+
+
+def test_query_variants_share_cache_entry(client, upstream):
+    client.get("/api/weather?q=London, UK")
+
+    resp = client.get("/api/weather?q=%20london%20,uk")
+
+    assert resp.get_json()["cached"] is True
+    assert upstream.count("direct") == 1
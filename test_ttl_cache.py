@@ -0,0 +1,72 @@
+from ttl_cache import ExpiringCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(maxsize, ttl=60, **kwargs):
+    clock = FakeClock()
+    return ExpiringCache(maxsize=maxsize, ttl=ttl, clock=clock, **kwargs), clock
+
+
+def test_get_returns_value_until_expiry():
+    cache, clock = make_cache(maxsize=4, ttl=10)
+    cache["a"] = 1
+    assert cache.get("a") == 1
+    clock.now += 10
+    assert cache.get("a") is None
+    assert cache.get("a", "miss") == "miss"
+
+
+def test_sweep_drops_expired_entries():
+    cache, clock = make_cache(maxsize=4, ttl=10)
+    cache["a"] = 1
+    clock.now += 5
+    cache["b"] = 2
+    clock.now += 6
+    cache.sweep()
+    assert len(cache) == 1
+    assert cache.get("b") == 2
+
+
+def test_new_key_survives_eviction_when_residents_were_read():
+    cache, clock = make_cache(maxsize=4)
+    for k in "abcd":
+        cache[k] = k
+        cache.get(k)
+        clock.now += 1
+    cache["new"] = "new"
+    assert len(cache) == 4
+    assert cache.get("new") == "new"
+
+
+def test_eviction_prefers_cold_keys():
+    cache, clock = make_cache(maxsize=3)
+    for k in "abc":
+        cache[k] = k
+        clock.now += 1
+    for _ in range(3):
+        cache.get("a")
+        cache.get("c")
+    cache["d"] = "d"
+    assert cache.get("b") is None
+    assert {k for k in "acd" if cache.get(k) is not None} == set("acd")
+
+
+def test_hit_counts_decay_so_old_hot_keys_age_out():
+    cache, clock = make_cache(maxsize=2, sweep_every=1)
+    cache["hot"] = 1
+    for _ in range(8):
+        cache.get("hot")
+    # each write halves hit counts; a steady stream of newly read keys
+    # eventually outranks the key that is no longer read
+    for i in range(10):
+        clock.now += 1
+        cache[i] = i
+        cache.get(i)
+    assert cache.get("hot") is None
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import heapq
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+# Hit count a new entry starts with, so a key that was just written is
+# not the cheapest eviction victim next to entries read only once
+NEW_ENTRY_HITS = 1.0
+
+
+class ExpiringCache:
+    """
+    Bounded dict cache with a per-entry expiry timestamp.
+
+    A read is one dict probe plus one clock() call (monotonic by default); expired entries
+    are ignored on read and dropped by a sweep every `sweep_every` writes
+    (default: `maxsize`), which also halves every hit count so keys that
+    stop being read age out. When the cache grows past `maxsize`, the
+    entries with the lowest hits + recency score are evicted (never the
+    key being written), so a burst of one-off keys does not push out
+    frequently read ones.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        sweep_every: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sweep_every = sweep_every or maxsize
+        # key -> [expires_at, value, hits, last_used]
+        self._data: Dict[Hashable, List[Any]] = {}
+        self._writes = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is not None:
+            now = self._clock()
+            if entry[0] > now:
+                # unlocked: counts are a heuristic, a lost update is harmless
+                entry[2] += 1
+                entry[3] = now
+                return entry[1]
+        return default
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            data = self._data
+            now = self._clock()
+            # an overwrite (e.g. refresh) keeps the key's hit count
+            old = data.get(key)
+            hits = old[2] if old else NEW_ENTRY_HITS
+            data[key] = [now + self.ttl, value, hits, now]
+            self._writes += 1
+            if self._writes % self.sweep_every == 0:
+                self._sweep(decay=True)
+            if len(data) > self.maxsize:
+                self._evict(keep=key)
+
+    def sweep(self) -> None:
+        with self._lock:
+            self._sweep(decay=True)
+
+    def _sweep(self, decay: bool = False) -> None:
+        now = self._clock()
+        data = self._data
+        for key in [k for k, entry in data.items() if entry[0] <= now]:
+            del data[key]
+        if decay:
+            for entry in data.values():
+                entry[2] /= 2
+
+    def _evict(self, keep: Hashable) -> None:
+        self._sweep()
+        data = self._data
+        excess = len(data) - self.maxsize
+        if excess <= 0:
+            return
+        now = self._clock()
+
+        # score = hits + recency in (0, 1]; ranking by log(score)
+        # would give the same order
+        def score(k: Hashable) -> float:
+            entry = data[k]
+            return entry[2] + 1.0 / (1.0 + now - entry[3])
+
+        candidates = (k for k in data if k != keep)
+        for key in heapq.nsmallest(excess, candidates, key=score):
+            del data[key]
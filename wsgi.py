@@ -0,0 +1,5 @@
+# WSGI entry point for production servers, e.g.:
+#   gunicorn -k gevent -w $(nproc) --worker-connections 1000 -b 0.0.0.0:5000 wsgi:app
+from app import app
+
+__all__ = ["app"]